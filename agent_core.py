@@ -1,11 +1,14 @@
-import json
-import re
+import time
+import random
 import logging
 
 import inspect
 from typing import Dict, Any, Callable, List, Optional
-from typing import get_type_hints, get_origin, get_args
-from functools import wraps
+from functools import wraps, lru_cache
+
+import orjson
+
+from agent_utils import resolve_hints, build_adapter, json_loads
 
 # ==================== 日志系统配置 ====================
 # 配置全局日志格式：时间 [级别] 内容
@@ -19,20 +22,116 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)  # 创建一个独立的 logger 实例
 
+# ==================== 重试策略 ====================
+# 只有网络类的瞬时错误才值得重试，参数错误等确定性异常重试也不会成功
+_RETRIABLE_ERRORS = (ConnectionError, TimeoutError)
+
+def _backoff_delay(attempt: int) -> float:
+    """
+    指数退避 + 随机抖动，单次等待不超过 8 秒
+    """
+    return min(8, (2 ** attempt) * 0.1) + random.uniform(0, 0.1)
+
+# ==================== 配置读取 ====================
+@lru_cache(maxsize=1)
+def _load_config() -> Dict[str, Any]:
+    """
+    读取 config.json，进程内只读取一次，后续 Agent 实例直接复用
+    """
+    with open("config.json", "rb") as f:
+        return orjson.loads(f.read())
+
+# ==================== 工具 Schema 生成 ====================
+# Python 类型到 JSON Schema 类型的映射，模块加载时构建一次
+_TYPE_MAP = {
+    int: "integer",
+    float: "number",
+    str: "string",
+    bool: "boolean",
+    list: "array",
+    dict: "object",
+    tuple: "array",
+    set: "array"
+}
+
+def _build_schema(func: Callable) -> Dict:
+    """
+    根据函数签名生成工具的 JSON Schema
+    """
+    sig = inspect.signature(func)
+    hints = resolve_hints(func)
+
+    properties = {}
+    required = []
+    for name, param in sig.parameters.items():
+        if name == "self":
+            continue
+
+        json_type = _TYPE_MAP.get(hints.get(name), "string")
+        properties[name] = {"type": json_type, "description": f"参数{name}的类型是{json_type}"}
+        if param.default == inspect.Parameter.empty:
+            required.append(name)
+
+    # 构建该工具的标准描述结构（模仿 OpenAI Functions 格式）
+    return {
+        "name": func.__name__,  # 工具函数名
+        "description": (func.__doc__ or "").strip(),  # 函数的文档字符串作为描述
+        "parameters": {
+            "type": "object",
+            "properties": properties,   # 参数属性（此处简化，实际可解析 type hints）
+            "required": required      # 必填参数（可扩展）
+        }
+    }
+
+# ==================== LLM 输出解析 ====================
+def _extract_json_object(text: str, start: int = 0) -> Optional[str]:
+    """
+    从 text[start:] 中找到第一个完整的 JSON 对象并返回其字符串
+    单次线性扫描：按 { } 统计嵌套深度，跳过字符串内的括号并处理转义字符
+    """
+    first_open = text.find("{", start)
+    if first_open < 0:
+        return None
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(first_open, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[first_open:i + 1]
+    # 括号未闭合
+    return None
+
+# 所有 Agent 实例与每次对话共用的 system 消息，不在每轮重新构建
+_SYSTEM_MSG = {"role": "system", "content": "你是一个智能助手，请根据用户的问题，使用工具回答问题。"}
+
 # ==================== Agent 内核类 ====================
 class Agent:
     def __init__(self):
         self.tools: Dict[str, Callable] = {}  # 存储注册的工具函数，键为工具名
+        self._adapters: Dict[str, Callable] = {}  # 每个工具按签名生成的调用适配器
         self.tool_schemas: List[Dict] = []   # 存储每个工具的 JSON Schema 描述
         self.max_retries = 3                 # 工具调用失败时的最大重试次数
         
-        config = json.load(open("config.json", "r"))
+        config = _load_config()
         self.qwen_api_key = config["QWen-API-KEY"]
         self.qwen_api_base = config["QWen-API-BASE"]
 
-        self.messages = [
-          {"role": "system", "content": "你是一个智能助手，请根据用户的问题，使用工具回答问题。"}
-        ]
+        self.messages = [_SYSTEM_MSG]
 
 
     def register_tool(self, func: Callable):
@@ -40,46 +139,12 @@ class Agent:
         装饰器：用于注册工具函数，并自动生成其 JSON Schema
         使用方式：@agent.register_tool
         """
-        # 构建该工具的标准描述结构（模仿 OpenAI Functions 格式）
-
-        sig = inspect.signature(func)
-        hints = get_type_hints(func)
-
-        properties = {}
-        required = []
-        type_map = {
-            int: "integer",
-            float: "number",
-            str: "string",
-            bool: "boolean",
-            list: "array",
-            dict: "object",
-            tuple: "array",
-            set: "array"
-        }
-
-        for name, param in sig.parameters.items():
-            if name == "self":
-                continue
-
-            hint = hints.get(name)
-            json_type = type_map.get(hint, "string")
-            properties[name] = {"type": json_type, "description": f"参数{name}的类型是{json_type}"}
-            if param.default == inspect.Parameter.empty:
-                required.append(name)
-
-        schema = {
-            "name": func.__name__,  # 工具函数名
-            "description": (func.__doc__ or "").strip(),  # 函数的文档字符串作为描述
-            "parameters": {
-                "type": "object",
-                "properties": properties,   # 参数属性（此处简化，实际可解析 type hints）
-                "required": required      # 必填参数（可扩展）
-            }
-        }
+        schema = _build_schema(func)
 
         # 将工具存入字典，便于后续调用
         self.tools[func.__name__] = func
+        # 生成按参数名展开的调用适配器，执行时避免 ** 解包
+        self._adapters[func.__name__] = build_adapter(func)
         # 将工具的 schema 加入列表，可用于提示 LLM 哪些工具可用
         self.tool_schemas.append(schema)
 
@@ -97,32 +162,36 @@ class Agent:
             Action: {"tool": "add", "parameters": {"a": 3, "b": 5}}
             Observation: ...
         """
+        # 按固定分隔符切分出 "Thought:" 与 "\nAction:" 之间的内容，不经过正则引擎
+        _, has_thought, rest = text.partition("Thought:")
+        thought_part, has_action, after = rest.partition("\nAction:")
+
+        if has_thought and has_action:
+            thought = thought_part.strip()
+            # 从 "Action:" 之后提取完整的 JSON 对象（支持任意层嵌套）
+            action_json_str = _extract_json_object(after)
+        else:
+            # 未找到 Thought 时设为默认值，仍尝试提取 Action
+            thought = "No thought."
+            action_idx = text.find("Action:")
+            action_json_str = _extract_json_object(text, action_idx) if action_idx >= 0 else None
+
+        if not action_json_str:
+            logger.warning("未在输出中找到有效的 Action JSON。")
+            return None
+
+        # 将 JSON 字符串解析为 Python 字典，只捕获 JSON 解析错误（orjson 与标准库的解析错误都是 ValueError）
         try:
-            # 使用正则提取 "Thought:" 后的内容
-            thought_match = re.search(r"Thought:\s*(.*?)\nAction:", text, re.DOTALL)
-            # 提取 "Action:" 和 "Observation:" 之间的 JSON 字符串
-            action_match = re.search(r"Action:\s*({.*?})\s*Observation:", text, re.DOTALL | re.MULTILINE)
-
-            # 获取 Thought 内容，若未匹配则设为默认值
-            thought = thought_match.group(1).strip() if thought_match else "No thought."
-            # 获取 Action JSON 字符串
-            action_json_str = action_match.group(1).strip() if action_match else None
-
-            if not action_json_str:
-                logger.warning("未在输出中找到有效的 Action JSON。")
-                return None
-
-            # 将 JSON 字符串解析为 Python 字典
-            action = json.loads(action_json_str)
-            # 将 Thought 也加入 action 字典，便于后续日志记录
-            action["thought"] = thought
-            return action  # 返回包含 thought 和 action 信息的字典
-
-        except Exception as e:
+            action = json_loads(action_json_str)
+        except ValueError as e:
             logger.error(f"解析 Action 失败：{e}")
             return None
 
-    def _execute_action(self, action: Dict[str, Any]) -> str:
+        # 将 Thought 也加入 action 字典，便于后续日志记录
+        action["thought"] = thought
+        return action  # 返回包含 thought 和 action 信息的字典
+
+    def _execute_action(self, action: Dict[str, Any]) -> Dict[str, Any]:
         """
         执行解析出的 Action，调用对应工具函数，支持失败重试
         返回 Observation（执行结果或错误信息）
@@ -132,26 +201,26 @@ class Agent:
 
         # 检查工具是否存在
         if tool_name not in self.tools:
-            return f"Error: 工具 '{tool_name}' 未注册或不存在。"
+            return {"status": "error", "message": f"工具 '{tool_name}' 未注册或不存在。"}
 
-        tool_func = self.tools[tool_name]  # 获取工具函数对象
+        tool_adapter = self._adapters[tool_name]  # 获取工具的调用适配器
 
         # 最多重试 max_retries 次
         for attempt in range(1, self.max_retries + 1):
             try:
                 logger.info(f"正在执行工具: {tool_name} (第 {attempt} 次尝试)")
-                result = tool_func(**tool_input)  # 调用工具函数，传入参数
+                result = tool_adapter(tool_input)  # 调用工具函数，传入参数
                 # 成功则返回标准格式的 success 结果
-                return json.dumps({"status": "success", "result": result})
+                return {"status": "success", "result": result}
             except Exception as e:
                 # 记录错误日志
                 logger.error(f"工具 {tool_name} 第 {attempt} 次执行失败: {str(e)}")
-                # 如果是最后一次尝试，返回错误信息
-                if attempt == self.max_retries:
-                    return json.dumps({"status": "error", "message": str(e)})
-                continue  # 继续下一次重试
+                # 不可重试的异常或最后一次尝试，直接返回错误信息
+                if attempt == self.max_retries or not isinstance(e, _RETRIABLE_ERRORS):
+                    return {"status": "error", "message": str(e)}
+                time.sleep(_backoff_delay(attempt))  # 退避后继续下一次重试
         # 理论上不会走到这里，但防止异常
-        return "Unknown execution error."
+        return {"status": "error", "message": "Unknown execution error."}
 
     def run(self, user_input: str):
         """
@@ -198,24 +267,23 @@ Action: {"tool": "add", "parameters": {"a": 3, "b": 5}}
 Observation: '''
 
 
-    def _mock_generate_reply(self, thought: str, observation: str) -> str:
+    def _mock_generate_reply(self, thought: str, observation: Dict[str, Any]) -> str:
         """
         模拟最终回复生成（实际中可让 LLM 总结）
-        这里简单解析 observation 并返回结果
+        这里直接读取 observation 字典并返回结果
         """
-        try:
-            obs = json.loads(observation)  # 解析 observation JSON
-            if obs["status"] == "success":
-                result = obs["result"]
-                return f"✅ 操作成功，结果是：{result}"
-            else:
-                msg = obs["message"]
-                return f"❌ 操作失败：{msg}"
-        except:
-            return "⚠️ 无法解析执行结果。"
+        if observation.get("status") == "success":
+            result = observation.get("result")
+            return f"✅ 操作成功，结果是：{result}"
+        msg = observation.get("message", "unknown")
+        return f"❌ 操作失败：{msg}"
     
 
 # ==================== 注册示例工具 ====================
+# 天气工具的候选值，模块加载时构建一次
+_TEMPS = (20, 22, 25, 27, 30)
+_CONDITIONS = ("晴天", "多云", "小雨")
+
 # 创建 Agent 实例
 agent = Agent()
 
@@ -231,10 +299,7 @@ def get_weather(city: str) -> str:
     """
     获取指定城市的天气。
     """
-    import random
-    temps = [20, 22, 25, 27, 30]
-    conditions = ["晴天", "多云", "小雨"]
-    return f"{city} 今天气温 {random.choice(temps)}°C，{random.choice(conditions)}"
+    return f"{city} 今天气温 {random.choice(_TEMPS)}°C，{random.choice(_CONDITIONS)}"
 
 # ==================== 主程序入口 ====================
 if __name__ == "__main__":
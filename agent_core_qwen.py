@@ -1,12 +1,17 @@
-import json
+import asyncio
+import random
+import hashlib
 import logging
 
 import inspect
-from typing import Dict, Any, Callable, List, Optional
-from typing import get_type_hints, get_origin, get_args
-from functools import wraps
+from typing import Dict, Any, Callable, List, Optional, Iterator, AsyncIterator
+from functools import wraps, lru_cache
 
-from openai import OpenAI
+import httpx
+import orjson
+from openai import AsyncOpenAI, APIError
+
+from agent_utils import resolve_hints, build_adapter, json_loads, json_dumps
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,58 +22,124 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 只有网络类的瞬时错误才重试，参数错误等确定性异常直接失败
+_RETRIABLE_ERRORS = (ConnectionError, TimeoutError, APIError)
+
+def _backoff_delay(attempt: int) -> float:
+    return min(8, (2 ** attempt) * 0.1) + random.uniform(0, 0.1)
+
+@lru_cache(maxsize=1)
+def _load_config() -> Dict[str, Any]:
+    with open("config.json", "rb") as f:
+        return orjson.loads(f.read())
+
+_TYPE_MAP = {
+    int: "integer",
+    float: "number",
+    str: "string",
+    bool: "boolean",
+    list: "array"
+}
+
+def _build_schema(func: Callable) -> Dict:
+    sig = inspect.signature(func)
+    hints = resolve_hints(func)
+    properties = {}
+    required = []
+
+    for name, param in sig.parameters.items():
+        if name == "self":
+            continue
+        json_type = _TYPE_MAP.get(hints.get(name), "string")
+        properties[name] = {"type": json_type, "description": f"参数{name}的类型是{json_type}"}
+        if param.default == inspect.Parameter.empty:
+            required.append(name)
+    return {
+        "type": "function",
+        "function": {
+            "name": func.__name__,
+            "description": (func.__doc__ or "").strip(),
+            "parameters": {
+                "type": "object",
+                "properties": properties,
+                "required": required
+            }
+        }
+    }
+
+# 批量请求时附加到每个工具参数中的问题序号
+_ROW_PARAM = "_row"
+
+def _with_row_param(schema: Dict) -> Dict:
+    """
+    生成批量请求使用的 schema：在工具参数中加入必填的问题序号，不修改原 schema。
+    """
+    function = schema["function"]
+    parameters = function["parameters"]
+    return {
+        **schema,
+        "function": {
+            **function,
+            "parameters": {
+                **parameters,
+                "properties": {
+                    **parameters["properties"],
+                    _ROW_PARAM: {"type": "integer", "description": "该调用对应的问题序号，从 1 开始"}
+                },
+                "required": [*parameters["required"], _ROW_PARAM]
+            }
+        }
+    }
+
+# 所有实例与每次对话共用同一个 system 消息对象，复制消息列表时只复制引用
+_SYSTEM_MSG = {"role": "system", "content": "你是一个智能助手，请根据用户的问题，使用工具回答问题。"}
+
 class Agent:
+    __slots__ = (
+        "tools", "tool_schemas", "_schemas_digest", "max_retries", "max_history_tokens",
+        "_cache", "max_cache_size", "messages", "qwen_api_key", "qwen_api_base",
+        "_clients", "_loop", "_adapters", "_tool_adapters", "_tool_index", "_batch_tool_schemas"
+    )
+
     def __init__(self):
         self.tools: Dict[str, Callable] = {}
+        self._adapters: Dict[str, Callable] = {}
         self.tool_schemas: List[Dict] = []
+        # 工具 schema 的摘要，作为缓存 key 的一部分，finalize 时生成
+        self._schemas_digest = ""
+        # 批量请求使用的 schema（带问题序号参数），finalize 时生成
+        self._batch_tool_schemas: List[Dict] = []
+        # finalize 之后生成的按下标分发的工具表，注册新工具时失效
+        self._tool_adapters: tuple = ()
+        self._tool_index: Optional[Dict[str, int]] = None
 
         self.max_retries = 3
+        # 发送给模型的历史消息上限（按字符数粗略估算 token）
+        self.max_history_tokens = 4096
+
+        # 以 (用户输入, 工具 schema) 为 key 缓存第一次 LLM 调用的结果
+        self._cache: Dict[bytes, Dict[str, Any]] = {}
+        self.max_cache_size = 512
 
-        self.messages: List[Dict] = [
-            {"role": "system", "content": "你是一个智能助手，请根据用户的问题，使用工具回答问题。"}
-        ]
+        self.messages: List[Dict] = [_SYSTEM_MSG]
 
-        config = json.load(open("config.json", "r"))
+        config = _load_config()
         self.qwen_api_key = config["QWen-API-KEY"]
-        self.qwen_api_base = config["QWen-API-BASE"]   
+        self.qwen_api_base = config["QWen-API-BASE"]
 
-    def register_tool(self, func: Callable):
-        sig = inspect.signature(func)
-        hints = get_type_hints(func)
-        properties = {}
-        required = []
-        
-        type_map = {
-            int: "integer",
-            float: "number",
-            str: "string",
-            bool: "boolean",
-            list: "array"
-        }
+        # 每个事件循环各持有一个客户端，循环内的请求复用同一个 keep-alive 连接池，省去重复的 DNS 与 TLS 握手；
+        # 连接绑定在创建它的事件循环上，不能跨循环复用
+        self._clients: Dict[asyncio.AbstractEventLoop, AsyncOpenAI] = {}
+        # 同步入口（run / stream / run_many / run_batch）共用的事件循环，首次使用时创建，close() 时关闭
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
 
-        for name, param in sig.parameters.items():
-            if name == "self":
-                continue
-            hint = hints.get(name)
-            json_type = type_map.get(hint, "string")
-            properties[name] = {"type": json_type, "description": f"参数{name}的类型是{json_type}"}
-            if param.default == inspect.Parameter.empty:
-                required.append(name)
-        schema = {
-            "type": "function",
-            "function": {
-                "name": func.__name__,
-                "description": (func.__doc__ or "").strip(),
-                "parameters": {
-                    "type": "object",
-                    "properties": properties,
-                    "required": required
-                }
-            }
-        }
+    def register_tool(self, func: Callable):
+        schema = _build_schema(func)
 
         self.tools[func.__name__] = func
+        self._adapters[func.__name__] = build_adapter(func)
         self.tool_schemas.append(schema)
+        self._tool_index = None
         
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -76,103 +147,318 @@ class Agent:
 
         return wrapper
 
-    def _qwen_llm_response(self, user_input: str) -> str:
-        self.messages.append({"role": "user", "content": user_input})
-        client = OpenAI(
-            api_key=self.qwen_api_key,
-            base_url=self.qwen_api_base
-        )
-        completion = client.chat.completions.create(
+    def finalize(self):
+        """
+        所有工具注册完成后调用，把工具表冻结为元组，执行时按下标取调用适配器。
+        同时把 tool_schemas 序列化一次，之后的请求不再重复序列化来计算缓存 key。
+        """
+        self._schemas_digest = hashlib.blake2b(orjson.dumps(self.tool_schemas)).hexdigest()
+        self._batch_tool_schemas = [_with_row_param(schema) for schema in self.tool_schemas]
+        self._tool_adapters = tuple(self._adapters.values())
+        self._tool_index = {name: idx for idx, name in enumerate(self._adapters)}
+
+    def _trim_messages(self, messages: List[Dict], keep_last: int = 1) -> None:
+        """
+        历史过长时从 system 之后最早的消息开始丢弃，system 与本轮的最后 keep_last 条消息始终保留。
+        中文场景下一个字符约对应一个 token，这里直接用字符数估算，不依赖具体分词器。
+        """
+        total = sum(len(message.get("content") or "") for message in messages)
+        while total > self.max_history_tokens and len(messages) > 1 + keep_last:
+            dropped = messages.pop(1)
+            total -= len(dropped.get("content") or "")
+
+    async def _qwen_llm_response(self, messages: List[Dict], user_input: str, batch: bool = False) -> Dict[str, Any]:
+        """
+        流式请求模型并拼接 tool_calls 的增量片段，返回 {"finish_reason": ..., "tool_calls": [...]}，
+        其中每个 tool_call 为 {"id": ..., "name": ..., "arguments": ...}。
+        batch 为 True 时使用带问题序号参数的 schema。
+        """
+        if self._tool_index is None:
+            self.finalize()
+
+        messages.append({"role": "user", "content": user_input})
+        self._trim_messages(messages)
+
+        cache_key = hashlib.blake2b((user_input + "|" + self._schemas_digest + ("|batch" if batch else "")).encode()).digest()
+        response = self._cache.get(cache_key)
+        if response is not None:
+            logger.info(f"命中缓存，跳过 LLM 调用: {user_input}")
+            return response
+
+        stream = await self._get_client().chat.completions.create(
             model="qwen-plus",
-            messages=self.messages,
-            tools=self.tool_schemas
+            messages=messages,
+            tools=self._batch_tool_schemas if batch else self.tool_schemas,
+            stream=True
         )
 
-        return completion.model_dump_json()
+        finish_reason = None
+        tool_calls: Dict[int, Dict[str, str]] = {}
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            for delta_call in choice.delta.tool_calls or ():
+                call = tool_calls.setdefault(delta_call.index, {"id": "", "name": "", "arguments": ""})
+                if delta_call.id:
+                    call["id"] = delta_call.id
+                if delta_call.function:
+                    if delta_call.function.name:
+                        call["name"] = delta_call.function.name
+                    if delta_call.function.arguments:
+                        call["arguments"] += delta_call.function.arguments
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+
+        response = {
+            "finish_reason": finish_reason,
+            "tool_calls": [tool_calls[idx] for idx in sorted(tool_calls)]
+        }
 
-    def _qwen_generate_reply(self, thought: str, observation: str) -> str:
-        self.messages.append({"role": "assistant", "content": f'大模型的选择是：{thought}，工具执行结果是：{observation}，请总结并输出最终答案'})
-        
-        client = OpenAI(
-            api_key=self.qwen_api_key,
-            base_url=self.qwen_api_base
-        )
-        completion = client.chat.completions.create(
+        # max_cache_size <= 0 表示不缓存；超出容量时淘汰最早写入的条目
+        if self.max_cache_size > 0:
+            while self._cache and len(self._cache) >= self.max_cache_size:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[cache_key] = response
+        return response
+
+    async def _qwen_generate_reply(self, messages: List[Dict], thought: str, observation: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        # 只在拼接提示词时序列化一次，紧凑格式且不转义中文
+        observation_str = json_dumps(observation)
+        # 工具结果过长时截断观察文本而不是丢弃本轮问题，至少保留 512 个字符
+        budget = max(self.max_history_tokens - len(messages[0]["content"]) - len(messages[-1]["content"]), 512)
+        if len(observation_str) > budget:
+            observation_str = observation_str[:budget] + "…（已截断）"
+        messages.append({"role": "assistant", "content": f'大模型的选择是：{thought}，工具执行结果是：{observation_str}，请总结并输出最终答案'})
+
+        # 本轮的用户问题和工具结果摘要始终保留，只丢弃更早的历史
+        self._trim_messages(messages, keep_last=2)
+        stream = await self._get_client().chat.completions.create(
             model="qwen-plus",
-            messages=self.messages
+            messages=messages,
+            stream=True
         )
 
-        response = json.loads(completion.model_dump_json())
-        return response.get("choices")[0].get("message", {}).get("content")
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    def _get_client(self) -> AsyncOpenAI:
+        """
+        返回当前事件循环对应的客户端，没有则创建。
+        """
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            # 循环关闭后无法再 await 关闭客户端，只能丢弃并提示调用方应先调用 aclose
+            for closed_loop in [l for l in self._clients if l.is_closed()]:
+                del self._clients[closed_loop]
+                logger.warning("事件循环已关闭但其客户端未关闭，连接池未正常释放；请在循环结束前 await agent.aclose()")
+            client = AsyncOpenAI(
+                api_key=self.qwen_api_key,
+                base_url=self.qwen_api_base,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                    timeout=30.0
+                )
+            )
+            self._clients[loop] = client
+        return client
+
+    async def aclose(self):
+        """
+        关闭当前事件循环对应的客户端及其连接池。
+        在自己的事件循环中调用 arun / astream 等协程时，需在该循环结束前 await 本方法。
+        """
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def close(self):
+        """
+        关闭同步入口使用的事件循环，以及该循环上的客户端和线程池。
+        """
+        loop = self._get_loop()
+        loop.run_until_complete(self.aclose())
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+        self._loop = None
 
     def run(self, user_input: str):
+        return self._get_loop().run_until_complete(self.arun(user_input))
+
+    def stream(self, user_input: str) -> Iterator[str]:
+        """
+        逐段产出最终回复，命令行中可以边生成边打印。
+        """
+        loop = self._get_loop()
+        reply_stream = self.astream(user_input)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(reply_stream.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(reply_stream.aclose())
+
+    async def arun(self, user_input: str):
+        """
+        run 的协程版本，可在同一事件循环中并发执行多个请求。
+        可以在任意事件循环中调用，每个循环使用各自的连接池，循环结束前需 await aclose() 释放；
+        同步代码请使用 run / run_many，由 close() 统一释放。
+        """
+        final_reply = "".join([piece async for piece in self.astream(user_input)])
+        logger.info(f"💬 最终回复: {final_reply}")
+        return final_reply
+
+    async def astream(self, user_input: str) -> AsyncIterator[str]:
         logger.info(f"💬 用户输入: {user_input}")
 
-        llm_response = self._qwen_llm_response(user_input)
+        # 每次调用使用独立的消息列表，并发执行时互不干扰
+        messages = list(self.messages)
+        llm_response = await self._qwen_llm_response(messages, user_input)
 
         action = self._parse_action(llm_response)
-        final_reply = ""
         if not action:
-            final_reply = "Agent 未能生成有效的 Action。"
-        else:
-            thought = action["thought"]
-            logger.info(f"🧠 推理过程 (Thought): {thought}")
+            yield "Agent 未能生成有效的 Action。"
+            return
+
+        thought = action["thought"]
+        logger.info(f"🧠 推理过程 (Thought): {thought}")
+
+        observation = await self._execute_action(action)
+        logger.info(f"👀 执行反馈 (Observation): {observation}")
+
+        async for piece in self._qwen_generate_reply(messages, thought, observation):
+            yield piece
+
+    def run_many(self, inputs: List[str]) -> List[str]:
+        return self._get_loop().run_until_complete(self.arun_many(inputs))
+
+    async def arun_many(self, inputs: List[str]) -> List[str]:
+        return await asyncio.gather(*(self.arun(x) for x in inputs))
+
+    def run_batch(self, inputs: List[str], rows_per_call: int = 4) -> List[str]:
+        return self._get_loop().run_until_complete(self.arun_batch(inputs, rows_per_call))
+
+    async def arun_batch(self, inputs: List[str], rows_per_call: int = 4) -> List[str]:
+        """
+        把多条用户输入按 rows_per_call 条一组拼进同一个请求，由模型为每条输入生成 tool_call，
+        各组请求之间再并发执行。返回的回复与 inputs 顺序一致。
+        """
+        if rows_per_call < 1:
+            raise ValueError(f"rows_per_call 必须是正整数，实际为 {rows_per_call}")
+
+        chunks = [inputs[i:i + rows_per_call] for i in range(0, len(inputs), rows_per_call)]
+        chunk_replies = await asyncio.gather(*(self._arun_rows(rows) for rows in chunks))
+        return [reply for replies in chunk_replies for reply in replies]
+
+    async def _arun_rows(self, rows: List[str]) -> List[str]:
+        if len(rows) == 1:
+            return [await self.arun(rows[0])]
+
+        prompt = f"请对下面每一个问题分别生成 tool_call，并在每个 tool_call 的 {_ROW_PARAM} 参数中填写它对应的问题序号：\n" + \
+            "\n".join(f"{idx}) {row}" for idx, row in enumerate(rows, 1))
+        messages = list(self.messages)
+        llm_response = await self._qwen_llm_response(messages, prompt, batch=True)
 
-            observation = self._execute_action(action)
-            logger.info(f"👀 执行反馈 (Observation): {observation}")
+        # 按模型填写的问题序号归组，不依赖 tool_call 的返回顺序
+        calls_by_row: Dict[int, List[Dict[str, str]]] = {}
+        for tool_call in llm_response["tool_calls"]:
+            try:
+                args = json_loads(tool_call["arguments"])
+            except (TypeError, ValueError):
+                args = None
+            row_idx = args.pop(_ROW_PARAM, None) if isinstance(args, dict) else None
+            if type(row_idx) is not int or not 1 <= row_idx <= len(rows):
+                logger.warning(f"tool_call 缺少有效的问题序号，已忽略: {tool_call}")
+                continue
+            calls_by_row.setdefault(row_idx, []).append({**tool_call, "arguments": json_dumps(args)})
 
-            final_reply = self._qwen_generate_reply(thought, observation)
-            logger.info(f"💬 最终回复: {final_reply}")
+        # 没有匹配到 tool_call 的问题退回单独执行
+        thought = llm_response["finish_reason"]
+        return list(await asyncio.gather(*(
+            self._areply_row(row, calls_by_row[idx], thought) if idx in calls_by_row else self.arun(row)
+            for idx, row in enumerate(rows, 1)
+        )))
 
-        self.messages = [
-            {"role": "system", "content": "你是一个智能助手，请根据用户的问题，使用工具回答问题。"}
-        ]
+    async def _areply_row(self, user_input: str, tool_calls: List[Dict[str, str]], thought: str) -> str:
+        logger.info(f"💬 用户输入: {user_input}")
+        observation = await self._execute_action({"actions": tool_calls, "thought": thought})
+        logger.info(f"👀 执行反馈 (Observation): {observation}")
 
+        messages = [*self.messages, {"role": "user", "content": user_input}]
+        final_reply = "".join([piece async for piece in self._qwen_generate_reply(messages, thought, observation)])
+        logger.info(f"💬 最终回复: {final_reply}")
         return final_reply
 
-    def _parse_action(self, llm_response: str) -> Optional[Dict[str, Any]]:
-        response = json.loads(llm_response)
-        if (response.get("choices") \
-            and len(response.get("choices")) \
-            and response.get("choices")[0].get("message", {}).get("tool_calls")):
+    def _parse_action(self, response: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if response["tool_calls"]:
             actions_wrapper = {
-                "actions": response.get("choices")[0].get("message", {}).get("tool_calls")
+                "actions": response["tool_calls"]
             }
-            actions_wrapper["thought"] = response.get("choices")[0].get("finish_reason")
+            actions_wrapper["thought"] = response["finish_reason"]
             return actions_wrapper
         else:
             return None
 
-    def _execute_action(self, action: Dict[str, Any]) -> str:
-        result = {}
-        for action in action["actions"]:
+    async def _call_with_retry(self, name: str, tool_adapter: Callable, args: Dict[str, Any]) -> Dict[str, Any]:
+        for attempt in range(1, self.max_retries + 1):
             try:
-                name = action.get("function", {}).get("name", "")
-                args = json.loads(action.get("function", {}).get("arguments"))
-                if name not in self.tools:
-                    raise ValueError(f"执行工具{name}未被注册")
+                logger.info(f"正在执行工具: {name} (第 {attempt} 次尝试)")
+                return {
+                    "status": "success",
+                    "result": await asyncio.to_thread(tool_adapter, args)
+                }
 
-                tool_func = self.tools[name]
-                for attempt in range(1, self.max_retries + 1):
-                    try:
-                        logger.info(f"正在执行工具: {name} (第 {attempt} 次尝试)")
-                        result[name] = {
-                            "status": "success",
-                            "result": tool_func(**args)
-                        }
-                        break
-
-                    except Exception as e:
-                        logger.error(f"工具 {name} 第 {attempt} 次执行失败: {str(e)}")
-                        if attempt == self.max_retries:
-                            result[name] = str(e)
-                            break
-                        continue
+            except Exception as e:
+                logger.error(f"工具 {name} 第 {attempt} 次执行失败: {str(e)}")
+                if attempt == self.max_retries or not isinstance(e, _RETRIABLE_ERRORS):
+                    return {"status": "error", "message": str(e)}
+                await asyncio.sleep(_backoff_delay(attempt))
+
+        return {"status": "error", "message": "Unknown execution error."}
+
+    async def _execute_action(self, action: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        执行全部 tool_call，返回与调用顺序一致的结果列表；同一工具被调用多次时每次结果都会保留。
+        """
+        if self._tool_index is None:
+            self.finalize()
+
+        results: List[Dict[str, Any]] = []
+        pending = []
+        tasks = []
+        for tool_call in action["actions"]:
+            name = tool_call["name"]
+            outcome = {"id": tool_call["id"], "name": name}
+            results.append(outcome)
+            try:
+                args = json_loads(tool_call["arguments"])
+                idx = self._tool_index.get(name, -1)
+                if idx < 0:
+                    raise ValueError(f"执行工具{name}未被注册")
             except Exception as e:
                 logger.error(str(e))
-                result[name] = str(e)
+                outcome.update(status="error", message=str(e))
+                continue
+
+            pending.append(outcome)
+            tasks.append(self._call_with_retry(name, self._tool_adapters[idx], args))
 
-        return json.dumps(result)
+        # 多个工具调用并发执行，各自在线程池中运行，结果按调用顺序写回
+        for outcome, result in zip(pending, await asyncio.gather(*tasks)):
+            outcome.update(result)
+
+        return results
+
+_TEMPS = (20, 22, 25, 27, 30)
 
 agent = Agent()
 
@@ -188,9 +474,9 @@ def get_weather(city: str) -> str:
     """
     获取指定城市的天气。
     """
-    import random
-    temps = [20, 22, 25, 27, 30]
-    return f"今天{city}的天气是{random.choice(temps)}度。"
+    return f"今天{city}的天气是{random.choice(_TEMPS)}度。"
+
+agent.finalize()
 
 
 if __name__ == "__main__":
@@ -199,3 +485,4 @@ if __name__ == "__main__":
 
     agent.run("3 加 5 等于多少？")
     agent.run("北京今天天气怎么样？")
+    agent.close()
@@ -0,0 +1,103 @@
+import re
+import json
+import inspect
+from typing import Dict, Any, Callable
+from typing import get_type_hints
+
+import orjson
+
+# ==================== JSON 编解码 ====================
+# orjson 只支持 64 位范围内的整数：解析时超出范围的整数会被静默转成 float，序列化时直接抛出 TypeError
+# 19 位及以上的数字可能超出范围，此时改用标准库 json 保证大整数精确
+_LONG_DIGITS_RE = re.compile(r"\d{19,}")
+
+def json_loads(data: str) -> Any:
+    """
+    解析 JSON 字符串，默认使用 orjson，含超长数字时退回标准库 json
+    """
+    if _LONG_DIGITS_RE.search(data):
+        return json.loads(data)
+    return orjson.loads(data)
+
+def json_dumps(obj: Any) -> str:
+    """
+    序列化为紧凑且不转义中文的 JSON 字符串，orjson 无法处理时（如超出 64 位的整数）退回标准库 json
+    """
+    try:
+        return orjson.dumps(obj).decode()
+    except TypeError:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str)
+
+# ==================== 类型注解 ====================
+def resolve_hints(func: Callable) -> Dict[str, Any]:
+    """
+    获取函数参数的类型注解
+    注解都是普通类型时直接读取 __annotations__，只有存在字符串注解才需要 get_type_hints 解析
+    """
+    hints = func.__annotations__
+    if any(isinstance(hint, str) for hint in hints.values()):
+        hints = get_type_hints(func)
+    return hints
+
+# ==================== 参数类型转换 ====================
+# 只做无损转换，无法精确转换的值直接抛出 TypeError / ValueError，不会悄悄改变结果
+# 适配器先用 type(value) is T 判断，类型已经正确时不会调用这些函数
+def _to_int(value: Any, name: str) -> int:
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"参数 {name} 期望整数，实际为 {value!r}") from None
+    raise TypeError(f"参数 {name} 期望整数，实际为 {value!r}")
+
+def _to_float(value: Any, name: str) -> float:
+    if isinstance(value, (int, float, str)) and not isinstance(value, bool):
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f"参数 {name} 期望数字，实际为 {value!r}") from None
+    raise TypeError(f"参数 {name} 期望数字，实际为 {value!r}")
+
+def _to_str(value: Any, name: str) -> str:
+    if isinstance(value, str):
+        return value
+    raise TypeError(f"参数 {name} 期望字符串，实际为 {value!r}")
+
+_CONVERTERS = {int: _to_int, float: _to_float, str: _to_str}
+
+# ==================== 工具调用适配器 ====================
+def build_adapter(func: Callable) -> Callable[[Dict[str, Any]], Any]:
+    """
+    生成工具调用适配器：adapter(params) 等价于 func(**params)
+    int/float/str 参数类型不符时先做无损转换，缺参、未知参数等错误仍由 func(**params) 报出
+    """
+    params = inspect.signature(func).parameters
+    hints = resolve_hints(func)
+    # (参数名, 期望类型, 转换函数, 默认值)，默认值（如显式传入的 None）不做转换
+    checks = tuple(
+        (name, hints[name], _CONVERTERS[hints[name]], param.default)
+        for name, param in params.items()
+        if hints.get(name) in _CONVERTERS
+    )
+    if not checks:
+        return lambda d: func(**d)
+
+    def adapter(d: Dict[str, Any]) -> Any:
+        converted = None
+        for name, expected, convert, default in checks:
+            if name in d:
+                value = d[name]
+                if type(value) is not expected and value is not default:
+                    # 只在需要转换时复制，不修改调用方的字典
+                    if converted is None:
+                        converted = dict(d)
+                    try:
+                        converted[name] = convert(value, name)
+                    except (TypeError, ValueError) as e:
+                        raise type(e)(f"{func.__name__}() {e}") from None
+        return func(**(d if converted is None else converted))
+    return adapter